@@ -1,56 +1,39 @@
 #!/usr/bin/env python3
+import functools
+import re
 import sys
-from urllib.parse import urlparse
 
+# Anchored RFC 1123 hostname pattern, compiled once at import:
+# - Labels: 1-63 chars, letters (a-z), digits (0-9), hyphens (-).
+# - Labels must not start/end with hyphens.
+# - Total length <= 253 chars (enforced by the lookahead).
+# - No consecutive dots, no leading dot; one trailing dot allowed (FQDN).
+_HOST_RE = re.compile(
+    r'(?=.{1,253}\Z)'
+    r'(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)'
+    r'(?:\.(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?))*'
+    r'\.?',
+    re.IGNORECASE | re.ASCII,
+)
+
+@functools.lru_cache(maxsize=4096)
 def is_valid_hostname(hostname: str) -> bool:
     """
-    Validate a hostname according to RFC 1123 using urllib.parse.
+    Validate a hostname according to RFC 1123 with a single anchored regex.
     - Labels: 1-63 chars, letters (a-z, A-Z), digits (0-9), hyphens (-).
     - Labels must not start/end with hyphens.
-    - Total length <= 255 chars.
-    - No consecutive dots, no leading/trailing dots.
+    - Total length <= 253 chars.
+    - No consecutive dots, no leading dot; a single trailing dot is allowed.
+
+    This is a purely syntactic check: URL constructs such as a port suffix
+    (host:port), userinfo (user@host), or IPv6 brackets are intentionally
+    rejected rather than stripped.
     """
-    # Check total length (max 255 chars)
+    # Length prefilter rejects pathological inputs before the regex runs;
+    # matching is case-insensitive so no .lower() copy is needed
     if len(hostname) > 255:
         return False
-
-    # Remove trailing dot if present (e.g., FQDNs in DNS)
-    hostname = hostname.rstrip('.')
-
-    # Check for empty hostname or invalid structure
-    if not hostname or hostname.startswith('.') or '..' in hostname:
-        return False
-
-    # Use urllib.parse to extract hostname (add scheme to make it a URL)
-    # This helps normalize and split the hostname
-    try:
-        parsed = urlparse(f'http://{hostname}')
-        if not parsed.hostname:
-            return False
-        hostname = parsed.hostname.lower()  # Normalize to lowercase (RFC 1123 is case-insensitive)
-    except ValueError:
-        return False
-
-    # Split into labels
-    labels = hostname.split('.')
-
-    # Validate each label
-    for label in labels:
-        # Check label length (1-63 chars)
-        if len(label) < 1 or len(label) > 63:
-            return False
-
-        # Check allowed characters (letters, digits, hyphens)
-        for char in label:
-            if not (char.isalnum() or char == '-'):
-                return False
-
-        # Check that label does not start or end with hyphen
-        if label.startswith('-') or label.endswith('-'):
-            return False
-
-    # Ensure at least one label (non-empty hostname)
-    return len(labels) > 0
+    return _HOST_RE.fullmatch(hostname) is not None
 
 def main():
     if len(sys.argv) != 2:
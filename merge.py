@@ -2,105 +2,51 @@
 """
 Update kustomization.yaml - only modifies global /spec/values/tcp or nodePorts/tcp patches
 Safely preserves all other patches (including targeted multi-op patches)
+
+Thin CLI over merge_core; import merge_core directly to batch many
+updates in one process.
 """
 
 import sys
-from pathlib import Path
-from typing import Dict, Any
-
-from ruamel.yaml import YAML
-from ruamel.yaml.scalarstring import LiteralScalarString
-
-yaml = YAML()
-yaml.indent(mapping=2, sequence=4, offset=2)
-yaml.width = 8192
-yaml.preserve_quotes = True
-
-
-# ── Configuration ───────────────────────────────────────────────────────────────
-
-CONFIG = {
-    "tcp": {
-        "path": "/spec/values/tcp",
-        "name": "global TCP host ports",
-        "value_fmt": "{ns}/{svc}:{cp}"
-    },
-    "nodeport": {
-        "path": "/spec/values/controller/service/nodePorts/tcp",
-        "name": "global NodePorts tcp",
-        "value_fmt": "{cp}"
-    }
-}
-
-
-def is_target_patch(patch_item: Any, target_path: str) -> bool:
-    """Check if this is a plain global add patch we want to manage"""
-    if not isinstance(patch_item, dict) or 'patch' not in patch_item:
-        return False
-    
-    # Must NOT have target: selector
-    if 'target' in patch_item:
-        return False
-    
-    content = str(patch_item['patch']).strip()
-    
-    # Should contain exactly our op + path
-    if f'- op: add' not in content or f'path: {target_path}' not in content:
-        return False
-    
-    # Avoid multi-op patches
-    if content.count('- op:') > 1:
-        return False
-        
-    return True
-
-
-def find_managed_patch_index(patches: list, target_path: str) -> int:
-    for i, item in enumerate(patches):
-        if is_target_patch(item, target_path):
-            return i
-    return -1
-
-
-def extract_port_mappings(patch_str: str) -> Dict[str, str]:
-    """Robust parsing of port:target from literal block"""
-    mappings = {}
-    lines = patch_str.splitlines()
-    capturing = False
-
-    for line in lines:
-        s = line.rstrip()
-        if 'value: |' in s:
-            capturing = True
+
+
+def _batch_operations(stream):
+    """Turn newline-delimited JSON edits into update_many operations.
+
+    Returns None after reporting the offending line when an edit is
+    malformed (bad JSON, unknown type, missing or mistyped fields).
+    """
+    import json
+
+    from merge_core import CONFIG
+
+    operations = []
+    for lineno, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
             continue
-            
-        if capturing and ':' in s:
-            content = s.lstrip()
-            if not content or not content[0].isdigit():
-                continue
-                
-            try:
-                key_part, value_part = content.split(':', 1)
-                key = key_part.strip()
-                value = value_part.split('#')[0].strip()  # remove inline comment if any
-                if key.isdigit():
-                    mappings[key] = value
-            except:
-                pass
-    return mappings
-
-
-def build_new_patch_content(path: str, mappings: Dict[str, str]) -> LiteralScalarString:
-    lines = [
-        "- op: add",
-        f"  path: {path}",
-        "  value: |"
-    ]
-    for port in sorted(mappings.keys(), key=int):
-        lines.append(f"    {port}: {mappings[port]}")
-    if not mappings:
-        lines.append("    {}")
-    return LiteralScalarString("\n".join(lines))
+        try:
+            edit = json.loads(line)
+            cfg = CONFIG[edit["type"]]
+            value_factory = cfg.value_factory
+            new = {}
+            if edit["type"] == "tcp":
+                new[int(edit["main_port"])] = value_factory(
+                    edit["namespace"], edit["service"], edit["container_port"])
+                if edit.get("second"):
+                    p, c = edit["second"]
+                    new[int(p)] = value_factory(edit["namespace"], edit["service"], c)
+            else:
+                new[int(edit["main_port"])] = value_factory(edit["container_port"])
+                if edit.get("second"):
+                    p, c = edit["second"]
+                    new[int(p)] = value_factory(c)
+            operations.append((edit["type"], new))
+        except (KeyError, TypeError, ValueError) as exc:
+            print(f"Error: invalid batch edit on line {lineno}: {exc!r}",
+                  file=sys.stderr)
+            return None
+    return operations
 
 
 def main():
@@ -116,8 +62,14 @@ def main():
                         help="Path to kustomization.yaml")
     parser.add_argument("--dry-run", action="store_true",
                         help="Preview changes without modifying file")
-
-    subparsers = parser.add_subparsers(dest="type", required=True,
+    parser.add_argument("--batch", type=argparse.FileType('r'), metavar="EDITS",
+                        help="Apply newline-delimited JSON edits from a file\n"
+                             "(or - for stdin) with one YAML parse+dump, e.g.\n"
+                             '{"type": "tcp", "main_port": 33105,\n'
+                             ' "namespace": "ns", "service": "svc",\n'
+                             ' "container_port": 31010, "second": [34905, 32010]}')
+
+    subparsers = parser.add_subparsers(dest="type", required=False,
                                        title="command", description="Choose patch type")
 
     # TCP
@@ -138,74 +90,38 @@ def main():
 
     args = parser.parse_args()
 
-    cfg = CONFIG[args.type]
+    if args.batch:
+        if args.type:
+            parser.error("--batch replaces the tcp/nodeport command")
+        from merge_core import update_many
+        operations = _batch_operations(args.batch)
+        if operations is None:
+            return 1
+        return update_many(args.file, operations, dry_run=args.dry_run)
+    if not args.type:
+        parser.error("a command (tcp/nodeport) is required unless --batch is given")
 
-    file_path = Path(args.file)
-    if not file_path.exists():
-        print(f"Error: File not found → {file_path}", file=sys.stderr)
-        return 1
+    from merge_core import CONFIG, update_file
 
-    data = yaml.load(file_path) or {}
-    patches = data.setdefault('patches', [])
-
-    idx = find_managed_patch_index(patches, cfg["path"])
-
-    # Current mappings
-    current = {}
-    if idx >= 0:
-        current = extract_port_mappings(str(patches[idx]['patch']))
+    cfg = CONFIG[args.type]
 
-    # New entries
+    # New entries (built from args alone, so the file need not be parsed yet)
     new = {}
+    value_factory = cfg.value_factory
 
     if args.type == "tcp":
-        new[str(args.host_port)] = cfg["value_fmt"].format(
-            ns=args.namespace, svc=args.service, cp=args.container_port)
+        new[args.host_port] = value_factory(
+            args.namespace, args.service, args.container_port)
         if args.second:
             p, c = args.second
-            new[str(p)] = cfg["value_fmt"].format(ns=args.namespace, svc=args.service, cp=c)
+            new[p] = value_factory(args.namespace, args.service, c)
     else:
-        new[str(args.node_port)] = str(args.container_port)
+        new[args.node_port] = value_factory(args.container_port)
         if args.second:
             p, c = args.second
-            new[str(p)] = str(c)
-
-    # Overlap check for nodeport
-    if args.type == "nodeport":
-        overlap = set(new.keys()) & set(current.keys())
-        if overlap:
-            print("Error: Refusing to overwrite existing nodePort(s):", file=sys.stderr)
-            for k in sorted(overlap, key=int):
-                print(f"  {k} already maps to {current[k]}", file=sys.stderr)
-            return 2
-
-    # Apply update (tcp = merge, nodeport = safe add after check)
-    current.update(new)
-
-    # Build new patch
-    new_patch_text = build_new_patch_content(cfg["path"], current)
-    new_entry = {'patch': new_patch_text}
-
-    if idx >= 0:
-        patches[idx] = new_entry
-        action = "Updated"
-    else:
-        patches.append(new_entry)
-        action = "Created new"
-
-    print(f"{action} global {cfg['name']} patch")
-    print(f"  Added/updated: {list(new.keys())}")
-
-    if args.dry_run:
-        print("\nPreview of the whole file (dry-run):")
-        print("─"*80)
-        yaml.dump(data, sys.stdout)
-        print("─"*80)
-    else:
-        yaml.dump(data, file_path)
-        print(f"File saved: {file_path}")
+            new[p] = value_factory(c)
 
-    return 0
+    return update_file(args.file, args.type, new, dry_run=args.dry_run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+"""
+Core logic for updating kustomization.yaml - only modifies global
+/spec/values/tcp or nodePorts/tcp patches.
+Safely preserves all other patches (including targeted multi-op patches)
+
+Import this module to apply many updates inside one process (see
+update_file / update_many); the merge.py CLI is a thin argv wrapper
+around update_file, so the ~100ms interpreter+import startup is paid
+once instead of per file.
+"""
+
+import io
+import mmap
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Tuple
+
+
+# ── Configuration ───────────────────────────────────────────────────────────────
+
+def _tcp_value(ns: str, svc: str, cp: int) -> str:
+    return f"{ns}/{svc}:{cp}"
+
+
+def _np_value(cp: int) -> str:
+    return str(cp)
+
+
+class PatchCfg(NamedTuple):
+    """Frozen per-type settings; attribute access is a fixed-offset read
+    instead of a dict hash+probe on the hot path"""
+    path: str
+    name: str
+    value_factory: Callable[..., str]
+
+
+CONFIG = {
+    "tcp": PatchCfg(
+        path="/spec/values/tcp",
+        name="global TCP host ports",
+        value_factory=_tcp_value
+    ),
+    "nodeport": PatchCfg(
+        path="/spec/values/controller/service/nodePorts/tcp",
+        name="global NodePorts tcp",
+        value_factory=_np_value
+    )
+}
+
+
+class LiteralStr(str):
+    """Plain str tagged for emission as a '|' block scalar"""
+
+
+class PortOverlapError(ValueError):
+    """Raised when a nodeport update would overwrite existing mappings"""
+
+    def __init__(self, overlap, current):
+        super().__init__(
+            f"refusing to overwrite existing nodePort(s): {sorted(overlap)}")
+        self.overlap = overlap
+        self.current = current
+
+
+# Importing ruamel.yaml costs ~30-80ms cold; build the configured
+# instances lazily so --help, argument errors and the mmap no-op fast
+# path never pay for it
+_yaml_instances = None
+
+
+def _get_yaml():
+    """Memoized (round-trip, safe) YAML instance pair.
+
+    Round-trip mode preserves quotes/comments for re-emit; the safe-mode
+    instance (plain dicts/lists, C loader when available, same indent
+    settings) handles comment-free files and patch-body re-parsing.
+    """
+    global _yaml_instances
+    if _yaml_instances is None:
+        from ruamel.yaml import YAML
+
+        try:
+            from ruamel.yaml.cyaml import CSafeLoader as _CSafeLoader  # noqa: F401
+        except ImportError:
+            print("Warning: ruamel.yaml.clib not installed; the pure-Python YAML "
+                  "parser is 10-50x slower on large files. "
+                  "Fix with: pip install ruamel.yaml.clib", file=sys.stderr)
+
+        yaml_rt = YAML()
+        yaml_rt.indent(mapping=2, sequence=4, offset=2)
+        yaml_rt.width = 8192
+        yaml_rt.preserve_quotes = True
+
+        yaml_ro = YAML(typ='safe')
+        yaml_ro.indent(mapping=2, sequence=4, offset=2)
+        yaml_ro.width = 8192
+        yaml_ro.allow_duplicate_keys = False
+        yaml_ro.default_flow_style = False
+
+        def _rep_literal(representer, data):
+            return representer.represent_scalar(
+                'tag:yaml.org,2002:str', str(data), style='|')
+
+        yaml_rt.representer.add_representer(LiteralStr, _rep_literal)
+        yaml_ro.representer.add_representer(LiteralStr, _rep_literal)
+
+        # Keep safe-mode re-emits shaped like the input, as the PyYAML
+        # dumper already does: loaded literal blocks (plain str by then)
+        # go back out as '|' scalars and mapping keys stay in document
+        # order instead of being sorted
+        def _rep_str(representer, data):
+            if '\n' in data:
+                return representer.represent_scalar(
+                    'tag:yaml.org,2002:str', data, style='|')
+            return representer.represent_str(data)
+
+        yaml_ro.representer.add_representer(str, _rep_str)
+        yaml_ro.representer.sort_base_mapping_type_on_output = False
+
+        _yaml_instances = (yaml_rt, yaml_ro)
+    return _yaml_instances
+
+
+# PyYAML backed by libyaml is the fastest load/dump for comment-free
+# files; memoized like the ruamel pair, empty tuple when unavailable
+_pyyaml_backend = None
+
+
+def _get_pyyaml():
+    """Memoized (module, CSafeLoader, dumper class) triple, or None when
+    PyYAML or its libyaml C extension is not installed"""
+    global _pyyaml_backend
+    if _pyyaml_backend is None:
+        try:
+            import yaml as pyyaml
+        except ImportError:
+            _pyyaml_backend = ()
+            return None
+        try:
+            from yaml import CSafeDumper, CSafeLoader
+        except ImportError:
+            # PyYAML without libyaml would mean its pure-Python
+            # SafeLoader, 5-10x slower than the C path - say so and let
+            # the ruamel backend handle the file instead
+            print("Warning: PyYAML installed without libyaml; skipping it. "
+                  "Fix with: pip install 'pyyaml[libyaml]' or install "
+                  "libyaml-dev", file=sys.stderr)
+            _pyyaml_backend = ()
+        else:
+            # Our own dumper subclass: add_representer mutates the class
+            # it is called on, and registering a plain-str representer on
+            # the shared CSafeDumper would leak into every other
+            # yaml.dump(..., Dumper=CSafeDumper) in the process
+            class _Dumper(CSafeDumper):
+                pass
+
+            _Dumper.add_representer(
+                LiteralStr,
+                lambda dumper, data: dumper.represent_scalar(
+                    'tag:yaml.org,2002:str', str(data), style='|'))
+            # Loaded literal blocks come back as plain str; re-emit any
+            # multiline string as '|' so other patches keep their shape
+            _Dumper.add_representer(
+                str,
+                lambda dumper, data: dumper.represent_scalar(
+                    'tag:yaml.org,2002:str', data,
+                    style='|' if '\n' in data else None))
+            _pyyaml_backend = (pyyaml, CSafeLoader, _Dumper)
+    return _pyyaml_backend or None
+
+
+# Compiled op+path matchers, one per managed path, built on first use
+_target_res: Dict[str, Any] = {}
+
+
+def _target_re(target_path: str):
+    regex = _target_res.get(target_path)
+    if regex is None:
+        regex = _target_res[target_path] = re.compile(
+            r'- op: add\s+path: ' + re.escape(target_path) + r'(?=\s|$)')
+    return regex
+
+
+def is_target_patch(patch_item: Any, target_path: str) -> bool:
+    """Check if this is a plain global add patch we want to manage"""
+    # Cheapest rejections first: shape, then the target: selector probe
+    if not isinstance(patch_item, dict) or 'target' in patch_item:
+        return False
+
+    # LiteralScalarString subclasses str, so use the scalar directly
+    # instead of materializing a fresh copy with str()
+    content = patch_item.get('patch')
+    if not isinstance(content, str):
+        return False
+
+    # The path is the rarer needle; a plain substring miss skips the
+    # regex for every non-matching patch
+    if target_path not in content:
+        return False
+
+    # Should contain exactly our op + path
+    if _target_re(target_path).search(content) is None:
+        return False
+
+    # Avoid multi-op patches
+    if content.count('- op:') > 1:
+        return False
+
+    return True
+
+
+def managed_mappings_present(file_path: Path, cfg: PatchCfg, new: Dict[int, str]) -> bool:
+    """mmap scan: True if the managed patch and every requested mapping
+    already appear verbatim in the file, so the YAML round-trip can be skipped.
+
+    The managed block is located by its exact 'op: add / path / value: |'
+    header, which must occur exactly once; every needle is then anchored
+    to a whole line (whitespace-only prefix, so commented-out lines never
+    match) and confined to that block's extent, so a matching mapping in
+    some other patch — e.g. a target:-selector patch carrying the same
+    'port: target' line — cannot fake a no-op verdict. Anything
+    ambiguous falls through to the full parse.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with buf:
+        # A target:-selector patch can replicate the managed header exactly;
+        # any file carrying one goes through the full parse instead.
+        if re.search(rb'(?m)^[ \t]*target:(?:[ \t]|$)', buf) is not None:
+            return False
+        block_re = re.compile(
+            rb'(?m)^[ \t]*- op: add[ \t]*\n'
+            rb'[ \t]+path: ' + re.escape(cfg.path.encode()) + rb'[ \t]*\n'
+            rb'([ \t]+)value: \|[+-]?[ \t]*\n')
+        header = block_re.search(buf)
+        if header is None or block_re.search(buf, header.end()) is not None:
+            return False
+        # Block extent: mapping lines are indented deeper than 'value: |';
+        # the block ends at the first non-blank line that is not.
+        end_re = re.compile(
+            rb'(?m)^[ \t]{0,' + str(len(header.group(1))).encode() + rb'}\S')
+        tail = end_re.search(buf, header.end())
+        end = tail.start() if tail is not None else len(buf)
+        return all(
+            re.compile(rb'(?m)^[ \t]+'
+                       + re.escape(f"{port}: {value}".encode())
+                       + rb'[ \t]*$').search(buf, header.end(), end) is not None
+            for port, value in new.items()
+        )
+
+
+def find_managed_patch_index(patches: list, target_path: str) -> int:
+    for i, item in enumerate(patches):
+        if is_target_patch(item, target_path):
+            return i
+    return -1
+
+
+# Extracts the op path out of a single-op add patch in one search
+_PATH_RE = re.compile(r'- op: add\s+path:\s*(\S+)')
+
+
+def index_patches(patches: list) -> Dict[str, int]:
+    """Build a managed-path -> position map in one walk over the patches.
+
+    Lookups against the map are O(1), so a batch of edits scans every
+    literal block once instead of once per operation. First occurrence
+    wins, matching find_managed_patch_index.
+    """
+    path_idx: Dict[str, int] = {}
+    # Hoist globals and bound methods to locals: the loop body runs once
+    # per patch and LOAD_FAST beats a dict lookup per name per iteration
+    _isinstance = isinstance
+    _dict = dict
+    _str = str
+    search = _PATH_RE.search
+    setdefault = path_idx.setdefault
+    for i, item in enumerate(patches):
+        if not _isinstance(item, _dict) or 'target' in item:
+            continue
+        content = item.get('patch')
+        if not _isinstance(content, _str) or content.count('- op:') > 1:
+            continue
+        m = search(content)
+        if m:
+            setdefault(m.group(1), i)
+    return path_idx
+
+
+# One multiline sweep collects every indented 'port: target' pair and
+# trims inline comments in the same pass. Multiline mode is spelled
+# (?m) inline because google-re2's compile() does not accept stdlib
+# re flags.
+_PORT_PATTERN = r'(?m)^[ \t]+(\d+)\s*:\s*([^\r\n#]*?)\s*(?:#[^\r\n]*)?$'
+
+# The mapping-line pattern runs once per patch body, the hottest regex
+# here; use google-re2's linear-time DFA when installed, stdlib re
+# otherwise - and fall back to re if re2 rejects the pattern rather
+# than dying at import
+try:
+    import re2 as _re2
+except ImportError:
+    _PORT_RE = re.compile(_PORT_PATTERN)
+else:
+    try:
+        _PORT_RE = _re2.compile(_PORT_PATTERN)
+    except Exception:
+        _PORT_RE = re.compile(_PORT_PATTERN)
+
+# Parsed mappings keyed by the patch text itself; the parse is pure, and
+# batched edits would otherwise re-scan blocks this process just built.
+# Capped like _dom_cache so a long-lived driver cannot accumulate every
+# patch body it has ever seen
+_mappings_cache: Dict[str, Dict[int, str]] = {}
+_MAPPINGS_CACHE_MAX = 64
+
+
+def _mappings_cache_put(patch_str: str, mappings: Dict[int, str]) -> None:
+    if len(_mappings_cache) >= _MAPPINGS_CACHE_MAX:
+        _mappings_cache.pop(next(iter(_mappings_cache)))
+    _mappings_cache[patch_str] = mappings
+
+
+def extract_port_mappings(patch_str: str) -> Dict[int, str]:
+    """Parse port:target from the literal block with a single regex findall.
+
+    Memoized on the patch text; callers get a copy they may mutate.
+    """
+    cached = _mappings_cache.get(patch_str)
+    if cached is None:
+        start = patch_str.find('value: |')
+        # Slice rather than pass a pos argument: re2's Pattern does not
+        # share stdlib re's findall(text, pos) signature
+        cached = ({} if start == -1
+                  else {int(k): v for k, v in _PORT_RE.findall(patch_str[start:])})
+        _mappings_cache_put(patch_str, cached)
+    return dict(cached)
+
+
+def build_new_patch_content(path: str, mappings: Dict[int, str]) -> LiteralStr:
+    header = ("- op: add", f"  path: {path}", "  value: |")
+    if not mappings:
+        return LiteralStr("\n".join((*header, "    {}")))
+    body = (f"    {port}: {mappings[port]}" for port in sorted(mappings))
+    return LiteralStr("\n".join((*header, *body)))
+
+
+def _splice_patch_text(raw: str, old_patch: str, new_patch: str):
+    """Replace one managed literal block inside the raw document text.
+
+    Every line of a block scalar carries the same indent prefix in the
+    file, so when the old block can be located verbatim and uniquely
+    (anchored on its path line) the edit is a re-indent plus one
+    str.replace - no emitter pass over the rest of the document.
+    Returns the updated text, or None so the caller falls back to a
+    full dump.
+    """
+    lines = old_patch.split('\n')
+    if len(lines) < 2:
+        return None
+
+    # The path line is unique per managed patch; derive the block indent
+    # from where it sits in the file
+    needle = lines[1]
+    pos = raw.find(needle)
+    if pos == -1 or raw.find(needle, pos + 1) != -1:
+        return None
+    line_start = raw.rfind('\n', 0, pos) + 1
+    prefix = raw[line_start:pos]
+    if prefix.strip(' '):
+        return None
+
+    old_block = '\n'.join(prefix + line if line else line for line in lines)
+    if raw.count(old_block) != 1:
+        return None
+
+    # Keep the chomping of the surrounding '|' header intact
+    if old_patch.endswith('\n') and not new_patch.endswith('\n'):
+        new_patch += '\n'
+    new_block = '\n'.join(
+        prefix + line if line else line for line in new_patch.split('\n'))
+    return raw.replace(old_block, new_block, 1)
+
+
+def apply_update(data: Dict[str, Any], patch_type: str, new: Dict[int, str],
+                 path_idx: Dict[str, int] = None) -> str:
+    """Merge `new` into the managed patch inside a loaded kustomization tree.
+
+    Mutates `data` in place and returns the action taken ("Updated" /
+    "Created new" / "Unchanged"). Raises PortOverlapError when a nodeport
+    key already exists. Pass the index_patches() map when applying several
+    updates to one tree; it is kept in sync on append.
+    """
+    cfg = CONFIG[patch_type]
+    patches = data.setdefault('patches', [])
+
+    if path_idx is None:
+        path_idx = index_patches(patches)
+    idx = path_idx.get(cfg.path, -1)
+
+    # Current mappings
+    current = {}
+    if idx >= 0:
+        current = extract_port_mappings(str(patches[idx]['patch']))
+
+    # Overlap check for nodeport
+    if patch_type == "nodeport":
+        overlap = set(new) & set(current)
+        if overlap:
+            raise PortOverlapError(overlap, current)
+
+    # Apply update (tcp = merge, nodeport = safe add after check);
+    # bail before the rebuild when the merge changes nothing
+    before = dict(current)
+    current.update(new)
+    if idx >= 0 and current == before:
+        return "Unchanged"
+
+    # Build new patch; seed the parse cache so a later edit in the same
+    # batch reads these mappings back without a scan
+    new_patch_text = build_new_patch_content(cfg.path, current)
+    _mappings_cache_put(new_patch_text, dict(current))
+    new_entry = {'patch': new_patch_text}
+
+    if idx >= 0:
+        patches[idx] = new_entry
+        return "Updated"
+    patches.append(new_entry)
+    path_idx[cfg.path] = len(patches) - 1
+    return "Created new"
+
+
+def update_file(file_path, patch_type: str, new: Dict[int, str], dry_run: bool = False) -> int:
+    """Apply a single update to one kustomization file.
+
+    Returns a process exit code; all diagnostics go to stdout/stderr so
+    the CLI can pass the result straight to sys.exit().
+    """
+    return update_many(file_path, [(patch_type, new)], dry_run=dry_run)
+
+
+# Loaded (raw text, tree) pairs keyed by (path, mtime_ns, size), so a
+# driver looping over updates in one process parses each file once.
+# Entries are popped on use and only re-inserted while tree and file
+# still agree (after a no-op, or right after a write), which keeps
+# dry-run mutations from ever being served back.
+_dom_cache: Dict[Tuple[str, int, int], Tuple[str, Any]] = {}
+_DOM_CACHE_MAX = 8
+
+
+def _stat_key(file_path: Path) -> Tuple[str, int, int]:
+    st = file_path.stat()
+    return (str(file_path), st.st_mtime_ns, st.st_size)
+
+
+def _dom_cache_put(key: Tuple[str, int, int], raw: str, data: Any) -> None:
+    if len(_dom_cache) >= _DOM_CACHE_MAX:
+        _dom_cache.pop(next(iter(_dom_cache)))
+    _dom_cache[key] = (raw, data)
+
+
+def update_many(file_path, operations: Iterable[Tuple[str, Dict[int, str]]],
+                dry_run: bool = False) -> int:
+    """Apply several (patch_type, mappings) operations to one file with a
+    single YAML parse and dump, amortizing the load cost across edits"""
+    file_path = Path(file_path)
+    if not file_path.exists():
+        print(f"Error: File not found → {file_path}", file=sys.stderr)
+        return 1
+
+    operations = list(operations)
+    # Nothing requested (e.g. an empty --batch stream): say so instead of
+    # letting the vacuous fast path below claim the mappings are present
+    if not operations:
+        print("No operations to apply")
+        return 0
+
+    # Fast path: if every requested tcp mapping is already in the file
+    # verbatim, skip the YAML parse+dump entirely. (Not applied to
+    # nodeport, where an existing key is an error, not a merge.)
+    if all(ptype == "tcp" and managed_mappings_present(file_path, CONFIG[ptype], new)
+           for ptype, new in operations):
+        print("No change: requested mapping(s) already present")
+        return 0
+
+    cache_key = _stat_key(file_path)
+    cached = _dom_cache.pop(cache_key, None)
+    if cached is not None:
+        raw, data = cached
+    else:
+        raw = file_path.read_text()
+        data = None
+
+    # Only pay for round-trip mode when there are comments to preserve;
+    # comment-free files take the C-accelerated PyYAML path when libyaml
+    # is available, falling back to ruamel's safe mode otherwise
+    has_comments = '#' in raw
+    pyyaml = None if has_comments else _get_pyyaml()
+    yaml_io = None
+    if pyyaml is not None:
+        mod, loader, _dumper = pyyaml
+        if data is None:
+            data = mod.load(raw, Loader=loader) or {}
+    else:
+        yaml_rt, yaml_ro = _get_yaml()
+        yaml_io = yaml_rt if has_comments else yaml_ro
+        if data is None:
+            data = yaml_io.load(raw) or {}
+
+    changed = False
+    can_splice = True
+    replacements = []
+    # Per-op status lines are buffered and only flushed once the outcome
+    # (write, dry-run preview, or all-no-op) is decided: a later op that
+    # fails must not leave 'Updated ...' messages describing edits that
+    # were never persisted
+    status = []
+    patches = data.get('patches') or []
+    path_idx = index_patches(patches)
+    for patch_type, new in operations:
+        cfg = CONFIG[patch_type]
+        old_i = path_idx.get(cfg.path, -1)
+        old_text = patches[old_i]['patch'] if 0 <= old_i < len(patches) else None
+        try:
+            action = apply_update(data, patch_type, new, path_idx)
+        except PortOverlapError as exc:
+            print("Error: Refusing to overwrite existing nodePort(s):", file=sys.stderr)
+            for k in sorted(exc.overlap):
+                print(f"  {k} already maps to {exc.current[k]}", file=sys.stderr)
+            print("No changes written", file=sys.stderr)
+            return 2
+
+        if action == "Unchanged":
+            status.append(f"No change: global {cfg.name} patch already up to date")
+            continue
+        changed = True
+        if action == "Updated" and old_text is not None:
+            replacements.append((str(old_text), str(data['patches'][old_i]['patch'])))
+        else:
+            # Appended a new patch entry: the raw-text splice can't place
+            # it, so this run takes the full dump path
+            can_splice = False
+        status.append(f"{action} global {cfg.name} patch")
+        status.append(f"  Added/updated: {list(new.keys())}")
+
+    print('\n'.join(status))
+
+    # Every operation was a no-op: skip the dump (and the file write)
+    # entirely; the untouched tree can be served to the next caller
+    if not changed:
+        _dom_cache_put(cache_key, raw, data)
+        return 0
+
+    # When every change replaced an existing managed block, splice the
+    # new blocks straight into the raw text: the rest of the document -
+    # comments included - is never re-emitted. Any miss falls back to a
+    # full dump.
+    serialized = None
+    if can_splice:
+        text = raw
+        for old_text, new_text in replacements:
+            text = _splice_patch_text(text, old_text, new_text)
+            if text is None:
+                break
+        serialized = text
+
+    # Serialize once into a buffer: the emitter's many small writes hit
+    # memory, and the file (or stdout) gets a single large write
+    if serialized is None:
+        if pyyaml is not None:
+            mod, _loader, dumper = pyyaml
+            serialized = mod.dump(data, Dumper=dumper, sort_keys=False,
+                                  default_flow_style=False, indent=2,
+                                  width=8192, allow_unicode=True)
+        else:
+            buf = io.StringIO()
+            yaml_io.dump(data, buf)
+            serialized = buf.getvalue()
+
+    if dry_run:
+        print("\nPreview of the whole file (dry-run):")
+        print("─"*80)
+        sys.stdout.write(serialized)
+        print("─"*80)
+    else:
+        # Write-then-rename so an interrupt never leaves a half-written file
+        tmp = file_path.with_suffix(file_path.suffix + '.tmp')
+        tmp.write_bytes(serialized.encode())
+        os.replace(tmp, file_path)
+        # Tree and file agree again; the next in-process update starts
+        # from this parse instead of re-reading
+        _dom_cache_put(_stat_key(file_path), serialized, data)
+        print(f"File saved: {file_path}")
+
+    return 0